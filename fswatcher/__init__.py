@@ -23,14 +23,21 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import os
 import sys
 
 __all__ = ['Watcher', 'ADDED', 'MODIFIED', 'REMOVED', 'get_changes', 'watch_concurrently']
 
 if sys.platform.startswith('linux'):
-    from _linux_inotify import *
+    # The fanotify backend avoids per-directory watches, but requires root.
+    if os.environ.get('FSWATCHER_BACKEND') == 'fanotify':
+        from _linux_fanotify import *
+    else:
+        from _linux_inotify import *
 elif sys.platform == 'darwin':
     from _mac_fsevents import *
+    # Only the Mac backend keeps an index that can be queried.
+    __all__ += ['FILE', 'DIRECTORY']
 else:
     raise Exception('Unsupported platform: %s' % sys.platform)
 
@@ -47,7 +54,8 @@ def main(watch_dirs):
             descriptions = {
                 ADDED: 'A',
                 MODIFIED: 'M',
-                REMOVED: 'R'
+                REMOVED: 'R',
+                None: '?'  # Events were lost; the path needs a rescan.
             }
             print '%s %s' % (descriptions[event], path)
     except KeyboardInterrupt:
@@ -0,0 +1,598 @@
+# Copyright (c) 2011, Patrick Dubroy
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Filesystem-wide backend based on fanotify (Linux 5.17+, requires root).
+
+Instead of one inotify watch per directory, a single mark is placed on each
+filesystem that contains a watched root, so setting up a watch does not
+depend on the size of the tree. Events identify the parent directory by its
+file handle; handles are resolved to paths with open_by_handle_at() and
+cached, and events outside of the watched roots are dropped.
+
+Unlike the inotify backend, callbacks are passed the path that actually
+changed, along with one of ADDED, MODIFIED, or REMOVED. If events were lost,
+each affected callback is passed its root path and None, meaning that the
+whole tree should be rescanned. That happens for every watch when the kernel
+event queue overflows, and for the watches that overlap a directory that was
+deleted before the events inside it could be read. Such a directory is
+located through the event for its deletion, which carries its own handle.
+
+The kernel queue holds 16384 events by default. Setting the environment
+variable FSWATCHER_FANOTIFY_UNLIMITED_QUEUE=1 removes the limit, which
+avoids overflows on busy filesystems but lets unread events use an
+unbounded amount of kernel memory.
+
+Watcher, get_changes, and watch_concurrently provide the same stream of
+(path, change) tuples as the Mac backend on top of these callbacks.
+"""
+
+import ctypes
+import errno
+import multiprocessing
+import os
+import Queue
+import select
+import struct
+import threading
+import time
+
+__all__ = ['Watcher', 'ADDED', 'MODIFIED', 'REMOVED', 'get_changes',
+    'watch_concurrently', 'add_watch', 'remove_watch', 'watch']
+
+ADDED = 'ADDED'
+MODIFIED = 'MODIFIED'
+REMOVED = 'REMOVED'
+
+# Constants defined by linux/fanotify.h.
+FAN_MODIFY              = 0x00000002
+FAN_MOVED_FROM          = 0x00000040
+FAN_MOVED_TO            = 0x00000080
+FAN_CREATE              = 0x00000100
+FAN_DELETE              = 0x00000200
+FAN_Q_OVERFLOW          = 0x00004000
+FAN_ONDIR               = 0x40000000
+
+FAN_CLOEXEC             = 0x00000001
+FAN_NONBLOCK            = 0x00000002
+FAN_CLASS_NOTIF         = 0x00000000
+FAN_UNLIMITED_QUEUE     = 0x00000010
+FAN_REPORT_FID          = 0x00000200
+FAN_REPORT_DIR_FID      = 0x00000400
+FAN_REPORT_NAME         = 0x00000800
+FAN_REPORT_TARGET_FID   = 0x00001000
+FAN_REPORT_DFID_NAME    = (FAN_REPORT_DIR_FID | FAN_REPORT_NAME)
+FAN_REPORT_DFID_NAME_TARGET = (FAN_REPORT_DFID_NAME | FAN_REPORT_FID |
+    FAN_REPORT_TARGET_FID)
+
+FAN_MARK_ADD            = 0x00000001
+FAN_MARK_REMOVE         = 0x00000002
+FAN_MARK_FILESYSTEM     = 0x00000100
+
+FAN_EVENT_INFO_TYPE_FID       = 1
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+
+AT_FDCWD                = -100
+O_PATH                  = 0x00200000
+
+# Description (as used by the 'struct' module) for the
+# fanotify_event_metadata struct, the fanotify_event_info_header struct,
+# the fixed part of fanotify_event_info_fid (fsid + file_handle header),
+# and the file_handle header on its own.
+FANOTIFY_EVENT_METADATA_DESC = 'IBBHQii'
+FANOTIFY_INFO_HEADER_DESC = 'BBH'
+FANOTIFY_INFO_FID_DESC = 'iiIi'
+FILE_HANDLE_DESC = 'Ii'
+
+# Watch for any new, removed, or modified files or directories.
+FAN_EVENTS = (FAN_CREATE | FAN_DELETE | FAN_MOVED_FROM | FAN_MOVED_TO |
+    FAN_MODIFY | FAN_ONDIR)
+
+# Number of bytes to read from the fanotify descriptor at once.
+READ_BUFFER_SIZE = 65536
+
+# Maximum number of directory handles to keep in the handle->path cache.
+handle_cache_size = 65536
+
+# Maximum number of deleted directories to wait for the location of, before
+# giving up and rescanning every watch on their filesystems.
+pending_limit = 4096
+
+# Time in seconds that a Watcher waits for events at a time, before checking
+# whether another thread has already delivered them.
+POLL_INTERVAL = 0.1
+
+libc = ctypes.cdll.LoadLibrary('libc.so.6')
+libc.fanotify_mark.argtypes = [
+    ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+
+# A hacky way to get at the errno global inside libc.
+libc.__errno_location.restype = ctypes.POINTER(ctypes.c_int)
+def geterr():
+    return errno.errorcode[libc.__errno_location().contents.value]
+
+# Besides the parent directory and name, have events report the handle of
+# the entry itself, so that deleted directories can be located.
+init_flags = (FAN_CLASS_NOTIF | FAN_CLOEXEC | FAN_NONBLOCK |
+    FAN_REPORT_DFID_NAME_TARGET)
+if os.environ.get('FSWATCHER_FANOTIFY_UNLIMITED_QUEUE') == '1':
+    init_flags |= FAN_UNLIMITED_QUEUE
+fanotify_fd = libc.fanotify_init(init_flags, os.O_RDONLY)
+if fanotify_fd == -1:
+    raise Exception('Failed to initialize fanotify: %s' % geterr())
+
+# Each entry is a Struct with the path, root, fsid, and callback of a watch.
+watches = []
+
+# Maps fsid -> Struct(path, mount_fd, refcount) for each marked filesystem.
+filesystems = {}
+
+# Serializes reading and dispatching events between threads.
+_lock = threading.RLock()
+
+# Handles of parent directories that couldn't be resolved because they were
+# deleted, waiting for the event that reveals where they were.
+_pending = set()
+
+# Maps (fsid, file_handle) -> list of (parent key, name) for each directory
+# that was deleted or moved away, while there are pending handles.
+_gone = {}
+
+class Struct(object):
+    def __init__(self, **entries): self.__dict__.update(entries)
+
+class _Statfs(ctypes.Structure):
+    """The statfs struct from sys/statfs.h, as used by glibc."""
+    _fields_ = [
+        ('f_type', ctypes.c_long),
+        ('f_bsize', ctypes.c_long),
+        ('f_blocks', ctypes.c_ulong),
+        ('f_bfree', ctypes.c_ulong),
+        ('f_bavail', ctypes.c_ulong),
+        ('f_files', ctypes.c_ulong),
+        ('f_ffree', ctypes.c_ulong),
+        ('f_fsid', ctypes.c_int * 2),
+        ('f_namelen', ctypes.c_long),
+        ('f_frsize', ctypes.c_long),
+        ('f_flags', ctypes.c_long),
+        ('f_spare', ctypes.c_long * 4),
+    ]
+
+
+class _HandleCache(object):
+    """Maps (fsid, file_handle) -> directory path.
+
+    The paths are also kept in a tree of path components, so that the
+    entries for a directory and everything below it can be dropped without
+    looking at the rest of the cache.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._paths = {}
+        # Each node is a list [children, key], where children maps a path
+        # component to a node and key is the cache key for that path, if any.
+        self._tree = [{}, None]
+
+    def __len__(self):
+        return len(self._paths)
+
+    def get(self, key):
+        return self._paths.get(key)
+
+    def _find(self, path, create=False):
+        node = self._tree
+        for name in path.split(os.sep):
+            if not name:
+                continue
+            if name not in node[0]:
+                if not create:
+                    return None
+                node[0][name] = [{}, None]
+            node = node[0][name]
+        return node
+
+    def add(self, key, path):
+        if key in self._paths:
+            self.discard(key)
+        if len(self._paths) >= handle_cache_size:
+            self.clear()
+        node = self._find(path, create=True)
+        if node[1] is not None:
+            del self._paths[node[1]]
+        node[1] = key
+        self._paths[key] = path
+
+    def discard(self, key):
+        path = self._paths.pop(key, None)
+        if path is not None:
+            node = self._find(path)
+            if node is not None and node[1] == key:
+                node[1] = None
+
+    def forget(self, dirpath):
+        """Drop the entries for dirpath and its subdirectories."""
+        parent, name = os.path.split(dirpath.rstrip(os.sep))
+        parent_node = self._find(parent)
+        if parent_node is None or name not in parent_node[0]:
+            return
+        pending = [parent_node[0].pop(name)]
+        while pending:
+            children, key = pending.pop()
+            if key is not None:
+                del self._paths[key]
+            pending.extend(children.values())
+
+    def discard_fsid(self, fsid):
+        for key in [k for k in self._paths if k[0] == fsid]:
+            self.discard(key)
+
+_handle_cache = _HandleCache()
+
+def _get_fsid(path):
+    """Return the filesystem id of path, in the same form that it appears
+    in fanotify events.
+    """
+    buf = _Statfs()
+    if libc.statfs(path, ctypes.byref(buf)) == -1:
+        raise Exception('Failed to statfs %s: %s' % (path, geterr()))
+    return tuple(buf.f_fsid)
+
+def _fanotify_mark(flags, path):
+    if libc.fanotify_mark(fanotify_fd, flags, FAN_EVENTS, AT_FDCWD, path) == -1:
+        raise Exception(
+            'Failed to mark filesystem for %s: %s' % (path, geterr()))
+
+def _is_under(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def add_watch(watchdir_path, callback):
+    root = os.path.realpath(watchdir_path)
+    fsid = _get_fsid(root)
+
+    with _lock:
+        # A single mark covers the whole filesystem, so only the first watch
+        # on each filesystem needs to create one.
+        if fsid not in filesystems:
+            _fanotify_mark(FAN_MARK_ADD | FAN_MARK_FILESYSTEM, root)
+            # Keep a descriptor open for resolving file handles on this
+            # filesystem with open_by_handle_at().
+            mount_fd = os.open(root, os.O_RDONLY)
+            filesystems[fsid] = Struct(path=root, mount_fd=mount_fd, refcount=0)
+        filesystems[fsid].refcount += 1
+
+        watches.append(
+            Struct(path=watchdir_path, root=root, fsid=fsid, callback=callback))
+
+def _parse_fid_info(data, offset, end):
+    """Parse a fanotify_event_info_fid record, and return a tuple
+    (fsid, handle, name). The name is empty for records of type FID.
+    """
+    fsid0, fsid1, handle_bytes, handle_type = struct.unpack_from(
+        FANOTIFY_INFO_FID_DESC, data, offset)
+
+    # The handle is passed as-is to open_by_handle_at(), so include the
+    # file_handle header along with the opaque bytes.
+    handle_start = offset + struct.calcsize('ii')
+    name_start = offset + struct.calcsize(FANOTIFY_INFO_FID_DESC) + handle_bytes
+    handle = data[handle_start:name_start]
+    name = data[name_start:end].split('\0', 1)[0]
+    return ((fsid0, fsid1), handle, name)
+
+def _read_events(fd):
+    """Return a list of (mask, info, fid) extracted from the fanotify events
+    that are available. info is a tuple (fsid, handle, name) identifying
+    the parent directory and the name of the entry that changed, and fid is
+    a tuple (fsid, handle) identifying the entry itself. Either may be None.
+    """
+    events = []
+
+    # The kernel only returns whole events, and fails with EINVAL if the
+    # buffer is too small for the first one.
+    try:
+        data = os.read(fd, READ_BUFFER_SIZE)
+    except OSError as e:
+        # Another thread read the events first.
+        if e.errno == errno.EAGAIN:
+            return events
+        raise
+
+    metadata_size = struct.calcsize(FANOTIFY_EVENT_METADATA_DESC)
+    header_size = struct.calcsize(FANOTIFY_INFO_HEADER_DESC)
+    offset = 0
+    while offset + metadata_size <= len(data):
+        (event_len, vers, reserved, metadata_len, mask, event_fd,
+            pid) = struct.unpack_from(FANOTIFY_EVENT_METADATA_DESC, data, offset)
+        # With FAN_REPORT_DFID_NAME the kernel doesn't open the file, but
+        # be careful not to leak a descriptor if it ever does.
+        if event_fd >= 0:
+            os.close(event_fd)
+
+        info = fid = None
+        info_offset = offset + metadata_len
+        end = offset + event_len
+        while info_offset + header_size <= end:
+            info_type, pad, info_len = struct.unpack_from(
+                FANOTIFY_INFO_HEADER_DESC, data, info_offset)
+            if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                info = _parse_fid_info(
+                    data, info_offset + header_size, info_offset + info_len)
+            elif info_type == FAN_EVENT_INFO_TYPE_FID:
+                fid = _parse_fid_info(
+                    data, info_offset + header_size, info_offset + info_len)[:2]
+            info_offset += info_len
+        events.append((mask, info, fid))
+        offset += event_len
+    return events
+
+def _resolve_dir(fsid, handle):
+    """Return the path of the directory with the given file handle, or None
+    if it no longer exists.
+    """
+    key = (fsid, handle)
+    path = _handle_cache.get(key)
+    if path is not None:
+        return path
+
+    fd = libc.open_by_handle_at(filesystems[fsid].mount_fd, handle, O_PATH)
+    if fd == -1:
+        # Most likely ESTALE, because the directory has been deleted.
+        return None
+    try:
+        path = os.readlink('/proc/self/fd/%d' % fd)
+    finally:
+        os.close(fd)
+    if path.endswith(' (deleted)'):
+        return None
+
+    _handle_cache.add(key, path)
+    return path
+
+def _get_event_type(mask, path):
+    added = mask & (FAN_CREATE | FAN_MOVED_TO)
+    removed = mask & (FAN_DELETE | FAN_MOVED_FROM)
+    if added and removed:
+        # The kernel merged several events for the same name, so the order
+        # is unknown; report whatever the final state is.
+        return ADDED if os.path.lexists(path) else REMOVED
+    if added:
+        return ADDED
+    if removed:
+        return REMOVED
+    return MODIFIED
+
+def _locate(key, seen=()):
+    """Return a list of the paths where the directory with the given cache
+    key is now, or was when it was deleted or moved away.
+    """
+    if key in seen:
+        return []
+    fsid, handle = key
+    path = _resolve_dir(fsid, handle)
+    if path is not None:
+        return [path]
+    paths = []
+    for parent_key, name in _gone.get(key, ()):
+        paths.extend(os.path.join(parent_path, name)
+            for parent_path in _locate(parent_key, seen + (key,)))
+    return paths
+
+def _get_rescans():
+    """Return the watches that overlap the pending directories which can now
+    be located, and stop waiting for those directories.
+    """
+    # When there are too many directories waiting, give up on locating
+    # them and rescan everything on their filesystems instead.
+    give_up = len(_pending) > pending_limit
+    rescan = set()
+    for key in list(_pending):
+        paths = _locate(key)
+        if not paths and not give_up:
+            continue
+        _pending.discard(key)
+        for watchinfo in watches:
+            if watchinfo.fsid != key[0]:
+                continue
+            if not paths or any(_is_under(path, watchinfo.root) or
+                    _is_under(watchinfo.root, path) for path in paths):
+                rescan.add(watchinfo)
+    if not _pending:
+        _gone.clear()
+    return rescan
+
+def _process_events(timeout=None):
+    """Wait up to `timeout` seconds for events to be available, and pass
+    them to the callbacks of the matching watches.
+    """
+    # Don't hold the lock while waiting, so that other threads can add and
+    # remove watches. The descriptor is non-blocking, so if another thread
+    # reads the events first, there will simply be nothing to read.
+    if not select.select([fanotify_fd], [], [], timeout)[0]:
+        return
+
+    with _lock:
+        events = [(mask, info, fid) for mask, info, fid
+            in _read_events(fanotify_fd)
+            if mask & FAN_Q_OVERFLOW or (info and info[0] in filesystems)]
+
+        # Events inside a deleted directory come before the one for the
+        # deletion itself, so find where the deleted directories were first.
+        for mask, info, fid in events:
+            if (fid is not None and mask & FAN_ONDIR and
+                    mask & (FAN_DELETE | FAN_MOVED_FROM)):
+                _gone.setdefault(fid, []).append(
+                    ((info[0], info[1]), info[2]))
+
+        overflow = False
+        for mask, info, fid in events:
+            if mask & FAN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            fsid, handle, name = info
+            dirpath = _resolve_dir(fsid, handle)
+            if dirpath is None:
+                # The directory was deleted before the event was read. Wait
+                # for the event for its deletion to find out where it was.
+                _pending.add((fsid, handle))
+                continue
+            path = dirpath if name == '.' else os.path.join(dirpath, name)
+
+            matching = [w for w in watches
+                if w.fsid == fsid and _is_under(path, w.root)]
+
+            event = _get_event_type(mask, path)
+            if mask & FAN_ONDIR:
+                if event == REMOVED:
+                    _handle_cache.forget(path)
+                elif event == ADDED and matching and fid is not None:
+                    # Remember new directories right away, in case they are
+                    # deleted again before events for their contents are read.
+                    _handle_cache.add(fid, path)
+
+            for watchinfo in matching:
+                watchinfo.callback(path, event)
+
+        if overflow:
+            # Events were lost, so every watch needs a full rescan.
+            _pending.clear()
+            _gone.clear()
+            rescan = watches
+        else:
+            rescan = _get_rescans()
+        for watchinfo in list(rescan):
+            watchinfo.callback(watchinfo.path, None)
+
+def watch():
+    while True:
+        _process_events()
+
+def remove_watch(watchdir_path, callback):
+    with _lock:
+        # Find all the matching watches.
+        matching = [w for w in watches
+            if w.path == watchdir_path and w.callback == callback]
+        assert len(matching) > 0, 'No matching watches found for %s' % watchdir_path
+
+        for watchinfo in matching:
+            watches.remove(watchinfo)
+            fs = filesystems[watchinfo.fsid]
+            fs.refcount -= 1
+            if fs.refcount == 0:
+                if libc.fanotify_mark(fanotify_fd,
+                        FAN_MARK_REMOVE | FAN_MARK_FILESYSTEM, FAN_EVENTS,
+                        AT_FDCWD, fs.path) == -1:
+                    print 'fanotify_mark returned error:', geterr()
+                os.close(fs.mount_fd)
+                del filesystems[watchinfo.fsid]
+                _handle_cache.discard_fsid(watchinfo.fsid)
+                _pending.difference_update(
+                    [k for k in _pending if k[0] == watchinfo.fsid])
+
+
+def watch_concurrently(paths):
+    master_conn, slave_conn = multiprocessing.Pipe()
+    queue = Queue.Queue()
+
+    # Create the watcher up front, so that no changes are missed between
+    # returning and the thread starting.
+    watcher = Watcher(paths)
+
+    def thread_main():
+        while not _process_messages(watcher, slave_conn):
+            change = watcher.next_change(POLL_INTERVAL)
+            if change:
+                queue.put(change)
+        watcher.destroy()
+
+    thread = threading.Thread(target=thread_main)
+    thread.start()
+    return (master_conn, queue)
+
+
+def _process_messages(watcher, conn):
+    while conn.poll():
+        message = conn.recv()
+        if message == 'stop':
+            return True
+        else:
+            conn.send(RuntimeError('Unrecognized message %s' % message))
+    return False
+
+
+def get_changes(paths, timeout=None):
+    return Watcher(paths).get_changes(timeout)
+
+
+class _ChangeIterator(object):
+
+    def __init__(self, watcher, timeout):
+        self.watcher = watcher
+        self.timeout = timeout
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.watcher.next_change(self.timeout)
+
+
+class Watcher(object):
+
+    def __init__(self, paths):
+        self.paths = (paths,) if isinstance(paths, basestring) else paths
+        self.changes = Queue.Queue()
+        for path in self.paths:
+            add_watch(path, self._callback)
+
+    def _callback(self, path, event):
+        self.changes.put((path, event))
+
+    def next_change(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                return self.changes.get_nowait()
+            except Queue.Empty:
+                pass
+
+            # Another thread may be reading the events for this watcher, so
+            # only wait a little while before checking the queue again.
+            wait_time = POLL_INTERVAL
+            if timeout is not None:
+                wait_time = min(wait_time, deadline - time.time())
+                if wait_time <= 0:
+                    return None
+            _process_events(wait_time)
+
+    def get_changes(self, timeout=None):
+        return _ChangeIterator(self, timeout)
+
+    def destroy(self):
+        for path in self.paths:
+            remove_watch(path, self._callback)
+        self.paths = ()
@@ -23,7 +23,9 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import collections
 import errno
+import fnmatch
 import functools
 import itertools
 import multiprocessing
@@ -48,6 +50,13 @@ ADDED = 'ADDED'
 MODIFIED = 'MODIFIED'
 REMOVED = 'REMOVED'
 
+FILE = 'FILE'
+DIRECTORY = 'DIRECTORY'
+
+# Sequence numbers for changes recorded by any FileModificationIndex. A single
+# counter is shared so that cursors can be compared across indexes.
+_sequence = itertools.count(1)
+
 
 def watch_concurrently(paths):
     master_conn, slave_conn = multiprocessing.Pipe()
@@ -88,8 +97,21 @@ def _process_messages(watcher, conn):
             return True
         elif message == 'get_index_size':
             conn.send(watcher.index_size())
+        elif message == 'get_cursor':
+            conn.send(watcher.cursor())
+        elif (isinstance(message, tuple) and len(message) == 2 and
+                message[0] in ('query', 'changes_since')):
+            # Reply with the error rather than letting a bad argument kill
+            # the watcher thread.
+            try:
+                if message[0] == 'query':
+                    conn.send(watcher.query(**message[1]))
+                else:
+                    conn.send(watcher.changes_since(message[1]))
+            except (TypeError, ValueError) as e:
+                conn.send(e)
         else:
-            conn.send(RuntimeException('Unrecognized message %s' % message))
+            conn.send(RuntimeError('Unrecognized message %r' % (message,)))
     return False
 
 
@@ -266,12 +288,93 @@ class Watcher(object):
             return self.streams[0].index.size()
         return 0
 
+    def query(self, pattern=None, prefix=None, kind=None, min_mtime=None,
+            max_mtime=None):
+        """Return a sorted list of indexed paths matching all of the given
+        criteria. See FileModificationIndex.query for details.
+        """
+        pool = NSAutoreleasePool.alloc().init()
+        results = set()
+        for stream in self.streams:
+            results.update(stream.index.query(
+                pattern, prefix, kind, min_mtime, max_mtime))
+        return sorted(results)
+
+    def cursor(self):
+        """Return a cursor that can be passed to changes_since."""
+        return max([s.index.cursor() for s in self.streams] or [0])
+
+    def changes_since(self, cursor):
+        """Return a list of (path, change) tuples for the paths that have
+        changed after `cursor`, oldest first, or None if the cursor has
+        expired. See FileModificationIndex.changes_since for details.
+        """
+        pool = NSAutoreleasePool.alloc().init()
+        changes = []
+        for stream in self.streams:
+            index_changes = stream.index.log_since(cursor)
+            if index_changes is None:
+                return None
+            changes.extend(index_changes)
+        changes.sort()
+        return [(path, change) for seq, path, change in changes]
+
+
+def _get_ext(name):
+    """Return the extension of name (including the dot) as used by the
+    extension index, or '' if it has none.
+    """
+    dot = name.rfind('.')
+    return name[dot:] if dot >= 0 else ''
+
+
+def _is_under(path, dirpath):
+    return path.startswith(dirpath.rstrip(os.sep) + os.sep)
+
+
+def _split_pattern(pattern):
+    """Return a tuple (dirpath, ext) with the literal directory that all
+    matches of the glob pattern must be under, and the extension that they
+    must all have. Either may be None if it can't be determined.
+    """
+    magic = [pattern.find(c) for c in '*?[' if c in pattern]
+    if not magic:
+        dirpath, ext = os.path.dirname(pattern), _get_ext(pattern)
+        return (dirpath or None, ext or None)
+    head = pattern[:min(magic)]
+    dirpath = head[:head.rfind('/')] if '/' in head else None
+
+    # Every match ends with the literal text after the last wildcard.
+    tail = pattern[max(pattern.rfind(c) for c in '*?]') + 1:]
+    ext = _get_ext(tail)
+    if not ext or '/' in ext:
+        ext = None
+    return (dirpath, ext)
+
 
 class FileModificationIndex(object):
-    """Tracks the modification times of all items in a directory tree."""
+    """Tracks the modification times of all items in a directory tree.
+
+    Besides the per-directory listings, the index maintains a set of known
+    directories, a map from extension to paths, the number of entries below
+    each directory, and a log of the most recent change to each path since
+    the index was built, so that it can be queried without touching the disk.
+    """
+
+    # Maximum number of REMOVED entries to keep in the log. When it is
+    # exceeded, the oldest half are dropped and older cursors expire.
+    tombstone_limit = 100000
 
     def __init__(self, root):
         self._index = {}
+        self._dirs = set()
+        self._by_ext = {}
+        self._counts = {}
+        self._log = collections.OrderedDict()
+        self._tombstones = 0
+        self._built = False
+        self._last_seq = 0
+        self._min_cursor = 0
         self.root = os.path.realpath(root)
 
     def _rescan(self, path, recursive=False):
@@ -282,11 +385,17 @@ class FileModificationIndex(object):
         if not recursive:
             # Ignore an exception caused by the directory being deleted.
             try:
-                return self._get_changes(path, os.listdir(path))
+                changes = self._get_changes(path, os.listdir(path))
             except OSError, e:
                 if e.errno == errno.ENOENT:
                     return []
                 raise
+            # A directory moved in from outside the root only produces an
+            # event for its parent, so its contents must be indexed too.
+            for added_path, change in list(changes):
+                if change == ADDED and added_path in self._dirs:
+                    changes.extend(self._rescan(added_path, True))
+            return changes
 
         changes = []
         for dirpath, dirnames, filenames in os.walk(path):
@@ -316,17 +425,114 @@ class FileModificationIndex(object):
             # also watch for modifications.
             if name not in old_contents:
                 changes.append((path, ADDED))
+                self._add_entry(path, isdir)
             else:
-                if not isdir and old_contents[name] != new_contents[name]:
+                if isdir != (path in self._dirs):
+                    # Replaced by an entry of a different type.
+                    changes.extend(self._remove_entry(path))
+                    changes.append((path, ADDED))
+                    self._add_entry(path, isdir)
+                elif not isdir and old_contents[name] != new_contents[name]:
                     changes.append((path, MODIFIED))
+                    self._record(path, MODIFIED)
                 del old_contents[name]
         # Any items left in the old dict must have been deleted.
         for path in (os.path.join(dirpath, name) for name in old_contents):
-            changes.append((path, REMOVED))
+            changes.extend(self._remove_entry(path))
         return changes
 
+    def _record(self, path, change):
+        """Make `change` the most recent change to path in the log. Changes
+        made while building the index are not logged.
+        """
+        if not self._built:
+            return
+        self._last_seq = next(_sequence)
+        old = self._log.pop(path, None)
+        if old is not None and old[1] == REMOVED:
+            self._tombstones -= 1
+        self._log[path] = (self._last_seq, change)
+        if change == REMOVED:
+            self._tombstones += 1
+            if self._tombstones > self.tombstone_limit:
+                self._prune()
+
+    def _prune(self):
+        """Drop the oldest REMOVED entries from the log, until only half of
+        tombstone_limit are left. Cursors from before the last entry that
+        was dropped can no longer be served.
+        """
+        expired = []
+        for path, (seq, change) in self._log.iteritems():
+            if self._tombstones - len(expired) <= self.tombstone_limit // 2:
+                break
+            if change == REMOVED:
+                expired.append(path)
+                self._min_cursor = seq
+        for path in expired:
+            del self._log[path]
+        self._tombstones -= len(expired)
+
+    def _adjust_counts(self, dirpath, delta):
+        """Add delta to the number of entries below dirpath and each of its
+        ancestors up to the root.
+        """
+        while True:
+            self._counts[dirpath] = self._counts.get(dirpath, 0) + delta
+            if dirpath == self.root or not _is_under(dirpath, self.root):
+                break
+            dirpath = os.path.dirname(dirpath)
+
+    def _add_entry(self, path, isdir):
+        if isdir:
+            self._dirs.add(path)
+        self._by_ext.setdefault(_get_ext(os.path.basename(path)), set()).add(path)
+        self._adjust_counts(os.path.dirname(path), 1)
+        self._record(path, ADDED)
+
+    def _remove_entry(self, path):
+        """Remove path from the secondary indexes. If it was a directory,
+        everything below it is forgotten as well. Returns a list of
+        (path, REMOVED) tuples for all of the removed paths.
+        """
+        self._adjust_counts(
+            os.path.dirname(path), -1 - self._counts.get(path, 0))
+        return self._forget_entry(path)
+
+    def _forget_entry(self, path):
+        changes = []
+        if path in self._dirs:
+            self._dirs.discard(path)
+            self._counts.pop(path, None)
+            for name in self._index.pop(path, {}):
+                changes.extend(self._forget_entry(os.path.join(path, name)))
+        paths = self._by_ext.get(_get_ext(os.path.basename(path)))
+        if paths is not None:
+            paths.discard(path)
+        self._record(path, REMOVED)
+        changes.append((path, REMOVED))
+        return changes
+
+    def _walk(self, dirpath):
+        """Generate the indexed paths below dirpath."""
+        pending = [dirpath]
+        while pending:
+            dirpath = pending.pop()
+            for name in self._index.get(dirpath, ()):
+                path = os.path.join(dirpath, name)
+                if path in self._dirs:
+                    pending.append(path)
+                yield path
+
+    def _get_mtime(self, path):
+        dirpath, name = os.path.split(path)
+        return self._index[dirpath][name]
+
     def build(self):
-        return self._rescan(self.root, True)
+        changes = self._rescan(self.root, True)
+        self._built = True
+        self._last_seq = self._min_cursor = next(_sequence)
+        return changes
 
     def rescan(self, path, recursive=False):
         path = os.path.realpath(path)
@@ -335,3 +541,91 @@ class FileModificationIndex(object):
 
     def size(self):
         return sum(len(entries) for entries in self._index.values())
+
+    def query(self, pattern=None, prefix=None, kind=None, min_mtime=None,
+            max_mtime=None):
+        """Return a sorted list of the paths in the index which match all of
+        the given criteria:
+
+        - pattern: a glob pattern (as understood by fnmatch) that the path
+          relative to the root must match, e.g. 'src/*.py'. Note that '*'
+          also matches '/'.
+        - prefix: a directory, absolute or relative to the root, that the
+          path must be below.
+        - kind: FILE or DIRECTORY.
+        - min_mtime, max_mtime: inclusive bounds on the modification time.
+        """
+        if kind not in (None, FILE, DIRECTORY):
+            raise ValueError('Invalid kind %r' % (kind,))
+        start = self.root
+        if prefix is not None:
+            start = os.path.normpath(os.path.join(self.root, prefix))
+        ext = None
+        if pattern is not None:
+            pattern_dir, ext = _split_pattern(pattern)
+            if pattern_dir is not None:
+                pattern_dir = os.path.normpath(
+                    os.path.join(self.root, pattern_dir))
+                if start == self.root or _is_under(pattern_dir, start):
+                    start = pattern_dir
+
+        # Use the extension index when the pattern determines the extension,
+        # unless there are fewer entries below the starting directory than
+        # paths with that extension. Otherwise walk the listings.
+        bucket = self._by_ext.get(ext, ()) if ext is not None else None
+        if bucket is not None and len(bucket) <= self._counts.get(start, 0):
+            candidates = (p for p in bucket if _is_under(p, start))
+        else:
+            candidates = self._walk(start)
+
+        root_len = len(self.root.rstrip(os.sep)) + 1
+        results = []
+        for path in candidates:
+            if kind is not None and (path in self._dirs) != (kind == DIRECTORY):
+                continue
+            if pattern is not None and not fnmatch.fnmatchcase(
+                    path[root_len:], pattern):
+                continue
+            if min_mtime is not None or max_mtime is not None:
+                mtime = self._get_mtime(path)
+                if min_mtime is not None and mtime < min_mtime:
+                    continue
+                if max_mtime is not None and mtime > max_mtime:
+                    continue
+            results.append(path)
+        results.sort()
+        return results
+
+    def cursor(self):
+        """Return a cursor that can be passed to changes_since."""
+        return self._last_seq
+
+    def log_since(self, cursor):
+        """Return a list of (seq, path, change) tuples from the log for the
+        paths that have changed after `cursor`, oldest first, or None if the
+        cursor has expired.
+        """
+        if cursor < self._min_cursor:
+            return None
+        changes = []
+        for path in reversed(self._log):
+            seq, change = self._log[path]
+            if seq <= cursor:
+                break
+            changes.append((seq, path, change))
+        changes.reverse()
+        return changes
+
+    def changes_since(self, cursor):
+        """Return a list of (path, change) tuples for the paths that have
+        changed after `cursor`, oldest first. Only the most recent change to
+        each path is reported.
+
+        Returns None if the cursor is from before the index was built, or
+        so old that the log no longer covers it; the caller should then use
+        query() to get the full state instead.
+        """
+        changes = self.log_since(cursor)
+        if changes is None:
+            return None
+        return [(path, change) for seq, path, change in changes]
@@ -72,6 +72,120 @@ class BasicTests(unittest.TestCase):
         assert no_more_changes(self.watcher)
 
 
+class IndexQueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = realpath(tempfile.mkdtemp(prefix='fswatcher-test-'))
+        os.makedirs(join(self.testdir, 'src', 'pkg'))
+        for name in ['setup.py', 'src/a.py', 'src/b.txt', 'src/pkg/c.py']:
+            touch(join(self.testdir, name))
+        self.index = fswatcher.FileModificationIndex(self.testdir)
+        self.index.build()
+
+    def tearDown(self):
+        assert 'fswatcher-test' in self.testdir
+        shutil.rmtree(self.testdir)
+
+    def paths(self, *names):
+        return sorted(join(self.testdir, name) for name in names)
+
+    def test_glob(self):
+        assert_equal(self.index.query('*.py'),
+            self.paths('setup.py', 'src/a.py', 'src/pkg/c.py'))
+        assert_equal(self.index.query('src/*.py'),
+            self.paths('src/a.py', 'src/pkg/c.py'))
+        assert_equal(self.index.query('src/?.txt'), self.paths('src/b.txt'))
+        assert_equal(self.index.query('src/pkg/*.py'), self.paths('src/pkg/c.py'))
+
+    def test_prefix_and_kind(self):
+        assert_equal(self.index.query(prefix='src/pkg'),
+            self.paths('src/pkg/c.py'))
+        assert_equal(self.index.query(prefix='src', kind=fswatcher.DIRECTORY),
+            self.paths('src/pkg'))
+        assert_equal(self.index.query('src*', kind=fswatcher.FILE),
+            self.paths('src/a.py', 'src/b.txt', 'src/pkg/c.py'))
+        self.assertRaises(ValueError, self.index.query, kind='dir')
+
+    def test_mtime(self):
+        path = join(self.testdir, 'src', 'a.py')
+        os.utime(path, (1000, 1000))
+        self.index.rescan(join(self.testdir, 'src'))
+        assert_equal(self.index.query(max_mtime=1000), [path])
+        assert_equal(self.index.query('*.py', min_mtime=1001),
+            self.paths('setup.py', 'src/pkg/c.py'))
+
+    def test_changes_since(self):
+        cursor = self.index.cursor()
+        assert_equal(self.index.changes_since(cursor), [])
+
+        touch(join(self.testdir, 'src', 'd.py'))
+        shutil.rmtree(join(self.testdir, 'src', 'pkg'))
+        self.index.rescan(join(self.testdir, 'src'))
+        assert_equal(sorted(self.index.changes_since(cursor)), [
+            (join(self.testdir, 'src', 'd.py'), fswatcher.ADDED),
+            (join(self.testdir, 'src', 'pkg'), fswatcher.REMOVED),
+            (join(self.testdir, 'src', 'pkg', 'c.py'), fswatcher.REMOVED),
+        ])
+        assert_equal(self.index.query('*.py'),
+            self.paths('setup.py', 'src/a.py', 'src/d.py'))
+        assert_equal(self.index.changes_since(self.index.cursor()), [])
+
+    def test_moved_in_tree(self):
+        outside = tempfile.mkdtemp(prefix='fswatcher-test-')
+        try:
+            os.makedirs(join(outside, 'tree', 'sub'))
+            touch(join(outside, 'tree', 'sub', 'x.py'))
+            cursor = self.index.cursor()
+            # Only the parent of the moved directory is rescanned.
+            os.rename(join(outside, 'tree'), join(self.testdir, 'tree'))
+            changes = self.index.rescan(self.testdir)
+        finally:
+            shutil.rmtree(outside)
+
+        expected = [(path, fswatcher.ADDED)
+            for path in self.paths('tree', 'tree/sub', 'tree/sub/x.py')]
+        assert_equal(sorted(changes), expected)
+        assert_equal(sorted(self.index.changes_since(cursor)), expected)
+        assert_equal(self.index.query('tree/*.py'), self.paths('tree/sub/x.py'))
+
+    def test_expired_cursor(self):
+        # The initial build isn't logged, so earlier cursors have expired.
+        assert_equal(self.index.changes_since(0), None)
+
+        self.index.tombstone_limit = 2
+        cursors = []
+        for name in ['setup.py', 'src/a.py', 'src/b.txt']:
+            cursors.append(self.index.cursor())
+            os.unlink(join(self.testdir, name))
+            self.index.rescan(os.path.dirname(join(self.testdir, name)))
+
+        # Going over the limit pruned the two oldest removals from the log.
+        assert_equal(self.index.changes_since(cursors[0]), None)
+        assert_equal(self.index.changes_since(cursors[1]), None)
+        assert_equal(self.index.changes_since(cursors[2]), [
+            (join(self.testdir, 'src', 'b.txt'), fswatcher.REMOVED),
+        ])
+
+    def test_replaced_by_other_type(self):
+        cursor = self.index.cursor()
+        path = join(self.testdir, 'src', 'pkg')
+        shutil.rmtree(path)
+        touch(path)
+
+        changes = self.index.rescan(join(self.testdir, 'src'))
+        assert_equal(changes, [
+            (join(path, 'c.py'), fswatcher.REMOVED),
+            (path, fswatcher.REMOVED),
+            (path, fswatcher.ADDED),
+        ])
+        assert_equal(self.index.changes_since(cursor), [
+            (join(path, 'c.py'), fswatcher.REMOVED),
+            (path, fswatcher.ADDED),
+        ])
+        assert_equal(self.index.query(prefix='src', kind=fswatcher.FILE),
+            self.paths('src/a.py', 'src/b.txt', 'src/pkg'))
+
+
 def wait_for_index_size(conn, expected_size):
     MAX_WAIT_TIME = 4
 
@@ -85,6 +199,19 @@ def wait_for_index_size(conn, expected_size):
         time.sleep(1)
 
 
+def wait_for_reply(conn, message, expected):
+    MAX_WAIT_TIME = 4
+
+    start_time = time.time()
+    while True:
+        conn.send(message)
+        reply = conn.recv()
+        if reply == expected or time.time() - start_time >= MAX_WAIT_TIME:
+            assert_equal(reply, expected)
+            return
+        time.sleep(0.1)
+
+
 class ConcurrentTests(unittest.TestCase):
 
     def setUp(self):
@@ -134,3 +261,32 @@ class ConcurrentTests(unittest.TestCase):
 
         for conn in self.connections:
             conn.send('stop')
+
+    def test_query_messages(self):
+        testdir = realpath(self.testdir)
+        touch(join(testdir, 'a.py'))
+        touch(join(testdir, 'b.txt'))
+        conn, _ = fswatcher.watch_concurrently(self.testdir)
+        wait_for_index_size(conn, 2)
+
+        conn.send(('query', {'pattern': '*.py'}))
+        assert_equal(conn.recv(), [join(testdir, 'a.py')])
+
+        conn.send('get_cursor')
+        cursor = conn.recv()
+        os.unlink(join(testdir, 'a.py'))
+        wait_for_reply(conn, ('changes_since', cursor),
+            [(join(testdir, 'a.py'), fswatcher.REMOVED)])
+        wait_for_reply(conn, ('query', {'kind': fswatcher.FILE}),
+            [join(testdir, 'b.txt')])
+
+        # Malformed messages are answered with an error, and the watcher
+        # keeps running.
+        for message in [('query',), ('query', {'kind': 'dir'}),
+                ('query', {'bogus': 1}), ('changes_since', None, 1)]:
+            conn.send(message)
+            assert isinstance(conn.recv(), Exception)
+        conn.send('get_index_size')
+        assert_equal(conn.recv(), 1)
+
+        conn.send('stop')
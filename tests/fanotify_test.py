@@ -0,0 +1,214 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from nose.tools import assert_equal
+from os.path import join, realpath
+
+# The fanotify backend can only be loaded on Linux, as root.
+try:
+    from fswatcher import _linux_fanotify as fanotify
+except Exception:
+    fanotify = None
+
+requires_fanotify = unittest.skipIf(
+    fanotify is None, 'fanotify is not available (requires Linux and root)')
+
+
+def touch(path):
+    if os.path.exists(path):
+        os.utime(path, None)
+    else:
+        open(path, 'w').close()
+
+
+def no_more_changes(watcher):
+    return watcher.next_change(timeout=0.5) is None
+
+
+def all_changes(watcher):
+    changes = []
+    change = watcher.next_change(timeout=0.5)
+    while change is not None:
+        changes.append(change)
+        change = watcher.next_change(timeout=0.5)
+    return changes
+
+
+def make_file_handle(handle):
+    return struct.pack(fanotify.FILE_HANDLE_DESC, len(handle), 1) + handle
+
+
+def make_info(info_type, fsid, handle, name=None):
+    """Return the bytes for a fanotify_event_info_fid record."""
+    fid = struct.pack('ii', *fsid) + make_file_handle(handle)
+    if name is not None:
+        fid += name + '\0'
+    # Records are padded to a multiple of 4 bytes.
+    fid += '\0' * (-len(fid) % 4)
+    header_size = struct.calcsize(fanotify.FANOTIFY_INFO_HEADER_DESC)
+    return struct.pack(fanotify.FANOTIFY_INFO_HEADER_DESC,
+        info_type, 0, header_size + len(fid)) + fid
+
+
+def make_event(mask, fsid, handle, name, child_handle):
+    """Return the bytes for a fanotify event with a DFID_NAME record and a
+    FID record.
+    """
+    info = (make_info(fanotify.FAN_EVENT_INFO_TYPE_DFID_NAME, fsid, handle, name) +
+        make_info(fanotify.FAN_EVENT_INFO_TYPE_FID, fsid, child_handle))
+    metadata_size = struct.calcsize(fanotify.FANOTIFY_EVENT_METADATA_DESC)
+    metadata = struct.pack(fanotify.FANOTIFY_EVENT_METADATA_DESC,
+        metadata_size + len(info), 3, 0, metadata_size, mask, -1, 1234)
+    return metadata + info
+
+
+@requires_fanotify
+class ParseTests(unittest.TestCase):
+
+    def read_events(self, data):
+        read_fd, write_fd = os.pipe()
+        try:
+            os.write(write_fd, data)
+            return fanotify._read_events(read_fd)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_read_events(self):
+        handle = '\x01\x02\x03\x04\x05\x06\x07\x08'
+        file_handle = '\x11\x12\x13\x14\x15\x16\x17\x18'
+        dir_handle = '\x21\x22\x23\x24\x25\x26\x27\x28\x29\x2a\x2b\x2c'
+        data = (
+            make_event(fanotify.FAN_CREATE, (7, -8), handle, 'a.py',
+                file_handle) +
+            make_event(fanotify.FAN_DELETE | fanotify.FAN_ONDIR, (7, -8),
+                handle, 'subdir', dir_handle))
+
+        assert_equal(self.read_events(data), [
+            (fanotify.FAN_CREATE,
+                ((7, -8), make_file_handle(handle), 'a.py'),
+                ((7, -8), make_file_handle(file_handle))),
+            (fanotify.FAN_DELETE | fanotify.FAN_ONDIR,
+                ((7, -8), make_file_handle(handle), 'subdir'),
+                ((7, -8), make_file_handle(dir_handle))),
+        ])
+
+    def test_overflow_event(self):
+        metadata_size = struct.calcsize(fanotify.FANOTIFY_EVENT_METADATA_DESC)
+        data = struct.pack(fanotify.FANOTIFY_EVENT_METADATA_DESC,
+            metadata_size, 3, 0, metadata_size, fanotify.FAN_Q_OVERFLOW, -1, 0)
+
+        assert_equal(self.read_events(data),
+            [(fanotify.FAN_Q_OVERFLOW, None, None)])
+
+
+@requires_fanotify
+class WatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        # Discard events left over from earlier tests, which would otherwise
+        # be delivered once the filesystem is marked again.
+        fanotify._process_events(0)
+        self.testdir = realpath(tempfile.mkdtemp(prefix='fswatcher-test-'))
+        self.watcher = fanotify.Watcher(self.testdir)
+
+    def tearDown(self):
+        self.watcher.destroy()
+        assert 'fswatcher-test' in self.testdir
+        shutil.rmtree(self.testdir)
+
+    def test_new_modify_delete_file(self):
+        path = join(self.testdir, 'blah')
+        touch(path)
+        assert_equal(self.watcher.next_change(timeout=2), (path, fanotify.ADDED))
+
+        with open(path, 'a') as f:
+            f.write('x')
+        assert_equal(self.watcher.next_change(timeout=2),
+            (path, fanotify.MODIFIED))
+
+        os.unlink(path)
+        assert_equal(self.watcher.next_change(timeout=2),
+            (path, fanotify.REMOVED))
+
+        assert no_more_changes(self.watcher)
+
+    def test_rename(self):
+        old_path = join(self.testdir, 'old')
+        new_path = join(self.testdir, 'new')
+        os.mkdir(old_path)
+        assert_equal(self.watcher.next_change(timeout=2),
+            (old_path, fanotify.ADDED))
+
+        os.rename(old_path, new_path)
+        touch(join(new_path, 'blah'))
+        assert_equal(all_changes(self.watcher), [
+            (old_path, fanotify.REMOVED),
+            (new_path, fanotify.ADDED),
+            (join(new_path, 'blah'), fanotify.ADDED),
+        ])
+
+    def test_outside_root(self):
+        otherdir = tempfile.mkdtemp(prefix='fswatcher-test-')
+        try:
+            touch(join(otherdir, 'blah'))
+            assert no_more_changes(self.watcher)
+        finally:
+            shutil.rmtree(otherdir)
+
+    def test_deleted_dirs_outside_root(self):
+        # Deleting directories elsewhere on the filesystem doesn't cause a
+        # rescan, even though their events can't be resolved.
+        otherdir = tempfile.mkdtemp(prefix='fswatcher-test-')
+        try:
+            for i in range(3):
+                path = join(otherdir, 'build%d' % i)
+                os.makedirs(join(path, 'sub'))
+                touch(join(path, 'sub', 'blah'))
+                shutil.rmtree(path)
+            assert no_more_changes(self.watcher)
+        finally:
+            shutil.rmtree(otherdir)
+
+    def test_destroy_while_waiting(self):
+        waiter = threading.Thread(target=fanotify._process_events, args=(2,))
+        waiter.start()
+        time.sleep(0.1)
+
+        start_time = time.time()
+        self.watcher.destroy()
+        assert time.time() - start_time < 1
+        waiter.join()
+
+    def test_merged_events(self):
+        # The create and delete of the same file are merged into a single
+        # event, which is reported according to the final state.
+        path = join(self.testdir, 'blah')
+        touch(path)
+        os.unlink(path)
+        assert_equal(all_changes(self.watcher), [(path, fanotify.REMOVED)])
+
+        # Replacing the file is a different object, so it isn't merged.
+        touch(path)
+        assert_equal(self.watcher.next_change(timeout=2), (path, fanotify.ADDED))
+        os.unlink(path)
+        touch(path)
+        assert_equal(all_changes(self.watcher), [
+            (path, fanotify.REMOVED),
+            (path, fanotify.ADDED),
+        ])
+
+    def test_deleted_parent(self):
+        # By the time the events are read, the directory is gone and the
+        # changes inside it can't be located.
+        path = join(self.testdir, 'subdir')
+        os.mkdir(path)
+        touch(join(path, 'blah'))
+        shutil.rmtree(path)
+
+        assert (self.testdir, None) in all_changes(self.watcher)